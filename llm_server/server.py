@@ -4,23 +4,74 @@ LLM Analysis Server for Shoulder App
 Provides local AI analysis of screenshots and activity data
 """
 
-import json
 import asyncio
+import hashlib
 import logging
+import re
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from contextlib import asynccontextmanager
 
+import httpx
+import orjson
 import uvicorn
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
-import ollama
 from ollama import AsyncClient
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ANALYSIS_CACHE_SIZE = 100  # Max analyses kept for repeated screenshots
+ANALYSIS_CACHE_TTL_SECONDS = 600.0  # Re-ask the model after this long
+OLLAMA_KEEPALIVE_SECONDS = 120.0  # Idle lifetime of pooled Ollama connections
+OLLAMA_MODEL_KEEP_ALIVE = "60m"  # Keep the model and its prompt cache loaded
+MODEL_LIST_TTL_SECONDS = 30.0  # How long /models may reuse Ollama's model list
+
+# Preferred models in order
+PREFERRED_MODELS = ("llama3.2:3b", "llama3.2:latest", "dolphin-mistral:latest", "llama3:latest")
+
+# App-name keywords that mark a development tool in the fallback heuristic
+DEV_APP_KEYWORDS = ("xcode", "vscode", "terminal", "sublime", "atom", "intellij")
+DEV_APP_PATTERN = re.compile("|".join(map(re.escape, DEV_APP_KEYWORDS)))
+
+# App-name keywords per category, checked in order; each category is
+# compiled into a single alternation so one scan covers all its keywords
+CATEGORY_KEYWORDS = {
+    "Development": ["code", "xcode", "terminal", "sublime", "atom", "intellij", "android studio"],
+    "Communication": ["slack", "discord", "teams", "zoom", "mail", "messages"],
+    "Research": ["safari", "chrome", "firefox", "edge", "arc"],
+    "Documentation": ["notes", "notion", "obsidian", "pages", "word"],
+    "Entertainment": ["spotify", "music", "tv", "youtube", "netflix"]
+}
+CATEGORY_PATTERNS = [
+    (category, re.compile("|".join(map(re.escape, keywords))))
+    for category, keywords in CATEGORY_KEYWORDS.items()
+]
+
+# Static instructions shared by every prompt; per-request fields are
+# appended after it so Ollama can reuse the cached prefix across requests
+PROMPT_HEADER = """You are a focus validator. Determine if the user's current activity matches their stated focus.
+
+Respond with JSON only:
+{
+  "is_valid": true/false,
+  "detected_activity": "Brief description of what user is actually doing",
+  "explanation": "Brief explanation of why this is/isn't aligned with their focus",
+  "confidence": 0.0 to 1.0
+}
+
+Examples:
+- Focus: "Writing code", Activity: Using Xcode → valid: true
+- Focus: "Writing code", Activity: Browsing Reddit → valid: false
+- Focus: "Research", Activity: Reading documentation → valid: true
+
+"""
+
 class AnalysisContext(BaseModel):
     app_name: str
     window_title: Optional[str] = None
@@ -39,70 +90,125 @@ class AnalysisResult(BaseModel):
     confidence: float = Field(ge=0.0, le=1.0)  # Model confidence
     timestamp: str  # Use ISO8601 string for compatibility
 
+def extract_model_names(response) -> List[str]:
+    """Extract model names from an Ollama list response"""
+    # Handle both dict and object responses
+    if hasattr(response, 'models'):
+        models_list = response.models
+    else:
+        models_list = response.get('models', [])
+    
+    model_names = []
+    for m in models_list:
+        if hasattr(m, 'name'):
+            model_names.append(m.name)
+        elif isinstance(m, dict):
+            model_names.append(m.get('name', ''))
+    return model_names
+
+class JSONObjectScanner:
+    """Tracks streamed text until the first top-level JSON object closes"""
+    
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+    
+    def feed(self, chunk: str) -> Optional[int]:
+        """Consume a chunk; return the offset just past the object's closing brace"""
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                # Quotes in any preamble before the object are ignored
+                self.in_string = self.depth > 0
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return None
+
 class LLMAnalyzer:
     def __init__(self):
-        self.client = AsyncClient()
+        # httpx's default pool caps with a longer idle expiry. Only fully read
+        # responses (/models, /pull_model) return their connection to the
+        # pool; an /analyze stream closed early is discarded instead
+        self.client = AsyncClient(
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=OLLAMA_KEEPALIVE_SECONDS
+            )
+        )
+        # Maps request hash to (monotonic expiry, result), oldest first
+        self.analysis_cache: "OrderedDict[bytes, Tuple[float, AnalysisResult]]" = OrderedDict()
+        # (monotonic expiry, names); cleared whenever a pull completes
+        self.model_names_cache: Optional[Tuple[float, List[str]]] = None
+        self.model: Optional[str] = None
+    
+    async def initialize(self):
+        """Select a model and pull it if needed, without blocking the loop"""
+        # List installed models once and share it between selection and pull
+        model_names = await self.fetch_model_names()
         # Use available model, prefer llama3.2:3b if available
-        self.model = self.get_available_model()
-        self.ensure_model_available()
+        self.model = self.get_available_model(model_names)
+        if model_names is not None:
+            await self.ensure_model_available(model_names)
     
-    def get_available_model(self):
-        """Get the best available model"""
+    async def fetch_model_names(self) -> Optional[List[str]]:
+        """List installed models, or None if Ollama is unreachable"""
         try:
-            response = ollama.list()
-            # Handle both dict and object responses
-            if hasattr(response, 'models'):
-                models_list = response.models
-            else:
-                models_list = response.get('models', [])
-            
-            model_names = []
-            for m in models_list:
-                if hasattr(m, 'name'):
-                    model_names.append(m.name)
-                elif isinstance(m, dict):
-                    model_names.append(m.get('name', ''))
-            
-            # Preferred models in order
-            preferred = ["llama3.2:3b", "llama3.2:latest", "dolphin-mistral:latest", "llama3:latest"]
-            
-            for model in preferred:
-                if any(model in name for name in model_names):
-                    logger.info(f"Using model: {model}")
-                    return model
-            
-            # If no preferred model, use first available
-            if model_names:
-                model = model_names[0].split(':')[0] + ':latest'
-                logger.info(f"Using available model: {model}")
-                return model
-            
-            # Default to dolphin-mistral since we know it's available
-            return "dolphin-mistral:latest"
+            return await self.list_model_names()
         except Exception as e:
             logger.error(f"Error checking models: {e}")
+            return None
+    
+    async def list_model_names(self) -> List[str]:
+        """List installed models, reusing a recent listing"""
+        now = time.monotonic()
+        if self.model_names_cache is not None and now < self.model_names_cache[0]:
+            return self.model_names_cache[1]
+        model_names = extract_model_names(await self.client.list())
+        self.model_names_cache = (now + MODEL_LIST_TTL_SECONDS, model_names)
+        return model_names
+    
+    async def pull_model(self, model_name: str):
+        """Pull a model and invalidate the cached model list"""
+        await self.client.pull(model_name)
+        self.model_names_cache = None
+    
+    def get_available_model(self, model_names: Optional[List[str]]):
+        """Get the best available model"""
+        if model_names is None:
             return "dolphin-mistral:latest"
+        
+        for model in PREFERRED_MODELS:
+            if any(model in name for name in model_names):
+                logger.info(f"Using model: {model}")
+                return model
+        
+        # If no preferred model, use first available
+        if model_names:
+            model = model_names[0].split(':')[0] + ':latest'
+            logger.info(f"Using available model: {model}")
+            return model
+        
+        # Default to dolphin-mistral since we know it's available
+        return "dolphin-mistral:latest"
     
-    def ensure_model_available(self):
+    async def ensure_model_available(self, model_names: List[str]):
         """Check if model is available, pull if necessary"""
         try:
-            response = ollama.list()
-            # Handle both dict and object responses
-            if hasattr(response, 'models'):
-                models_list = response.models
-            else:
-                models_list = response.get('models', [])
-            
-            model_names = []
-            for m in models_list:
-                if hasattr(m, 'name'):
-                    model_names.append(m.name)
-                elif isinstance(m, dict):
-                    model_names.append(m.get('name', ''))
-            
             if not any(self.model in name for name in model_names):
                 logger.info(f"Pulling model {self.model}...")
-                ollama.pull(self.model)
+                await self.pull_model(self.model)
                 logger.info(f"Model {self.model} ready")
             else:
                 logger.info(f"Model {self.model} is available")
@@ -121,28 +227,62 @@ class LLMAnalyzer:
         logger.info(f"   Model: {request.model}")
         
         prompt = self._build_prompt(request.text, request.context)
+        cache_key = self._cache_key(request.model, prompt)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            logger.info("Step 2: Cache hit, reusing previous analysis")
+            logger.info("=" * 50)
+            return cached.model_copy(update={"timestamp": datetime.now().isoformat()})
+        
         logger.info(f"Step 2: Built prompt ({len(prompt)} chars)")
-        logger.info(f"   Prompt preview: {prompt[:200]}...")
+        logger.info(f"   Prompt preview: ...{prompt[-200:]}")
         
         try:
             logger.info(f"Step 3: Sending to Ollama ({request.model})...")
-            start_time = datetime.now()
+            start_time = time.perf_counter()
             
-            response = await self.client.generate(
+            # Stream tokens so each chunk is decoded while the rest of the
+            # completion is still being generated, and stop as soon as the
+            # JSON answer is complete instead of waiting for trailing text.
+            # JSON mode keeps the model from emitting prose or fences, so the
+            # first balanced object in the stream is the answer itself
+            stream = await self.client.generate(
                 model=request.model,
                 prompt=prompt,
+                format="json",
+                stream=True,
+                keep_alive=OLLAMA_MODEL_KEEP_ALIVE,
                 options={
                     "temperature": 0.3,
                     "top_p": 0.9,
                     "max_tokens": 500
                 }
             )
+            scanner = JSONObjectScanner()
+            parts = []
+            try:
+                async for chunk in stream:
+                    text = chunk['response']
+                    end = scanner.feed(text)
+                    if end is not None:
+                        parts.append(text[:end])
+                        break
+                    parts.append(text)
+            finally:
+                # Closing the stream disconnects, which ends generation in Ollama
+                await stream.aclose()
+            response_text = "".join(parts)
             
-            elapsed = (datetime.now() - start_time).total_seconds()
+            elapsed = time.perf_counter() - start_time
             logger.info(f"Step 4: Ollama responded in {elapsed:.2f}s")
-            logger.info(f"   Response length: {len(response.get('response', ''))} chars")
+            logger.info(f"   Response length: {len(response_text)} chars")
+            
+            result = self._parse_response(response_text)
+            if result is None:
+                logger.info("Step 5: Using fallback analysis")
+                return self._fallback_analysis(request.text, request.context)
             
-            result = self._parse_response(response['response'], request.context)
+            self._put_cached(cache_key, result)
             
             logger.info(f"Step 5: Parsed response successfully")
             logger.info(f"   Focus: {request.context.user_focus}")
@@ -159,12 +299,39 @@ class LLMAnalyzer:
             logger.info("Step 5: Using fallback analysis")
             return self._fallback_analysis(request.text, request.context)
     
+    def _get_cached(self, key: bytes) -> Optional[AnalysisResult]:
+        """Return a live cached result and mark it most recently used"""
+        entry = self.analysis_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if time.monotonic() >= expires_at:
+            del self.analysis_cache[key]
+            return None
+        self.analysis_cache.move_to_end(key)
+        return result
+    
+    def _put_cached(self, key: bytes, result: AnalysisResult):
+        """Store a result, evicting the least recently used past capacity"""
+        self.analysis_cache[key] = (time.monotonic() + ANALYSIS_CACHE_TTL_SECONDS, result)
+        self.analysis_cache.move_to_end(key)
+        if len(self.analysis_cache) > ANALYSIS_CACHE_SIZE:
+            self.analysis_cache.popitem(last=False)
+    
+    def _cache_key(self, model: str, prompt: str) -> bytes:
+        """Hash the model and final prompt, which fully determine the analysis"""
+        # surrogatepass: request JSON may carry lone surrogates, which strict
+        # UTF-8 encoding rejects
+        h = hashlib.blake2b(digest_size=16)
+        h.update(model.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+        h.update(prompt.encode("utf-8", "surrogatepass"))
+        return h.digest()
+    
     def _build_prompt(self, text: str, context: AnalysisContext) -> str:
         """Build focus validation prompt"""
         
-        return f"""You are a focus validator. Determine if the user's current activity matches their stated focus.
-
-USER'S STATED FOCUS: {context.user_focus}
+        return PROMPT_HEADER + f"""USER'S STATED FOCUS: {context.user_focus}
 
 CURRENT ACTIVITY:
 - Application: {context.app_name}
@@ -173,23 +340,10 @@ CURRENT ACTIVITY:
 
 TASK: Does the current activity align with the user's focus of "{context.user_focus}"?
 
-Respond with JSON only:
-{{
-  "is_valid": true/false,
-  "detected_activity": "Brief description of what user is actually doing",
-  "explanation": "Brief explanation of why this is/isn't aligned with their focus",
-  "confidence": 0.0 to 1.0
-}}
-
-Examples:
-- Focus: "Writing code", Activity: Using Xcode → valid: true
-- Focus: "Writing code", Activity: Browsing Reddit → valid: false
-- Focus: "Research", Activity: Reading documentation → valid: true
-
 JSON response:"""
     
-    def _parse_response(self, response: str, context: AnalysisContext) -> AnalysisResult:
-        """Parse LLM response into structured result"""
+    def _parse_response(self, response: str) -> Optional[AnalysisResult]:
+        """Parse LLM response into structured result, or None if unparseable"""
         try:
             response = response.strip()
             if "```json" in response:
@@ -197,7 +351,7 @@ JSON response:"""
             elif "```" in response:
                 response = response.split("```")[1].split("```")[0]
             
-            data = json.loads(response)
+            data = orjson.loads(response)
             
             return AnalysisResult(
                 is_valid=bool(data.get("is_valid", False)),
@@ -209,18 +363,19 @@ JSON response:"""
         except Exception as e:
             logger.error(f"Failed to parse response: {e}")
             logger.error(f"Raw response was: {response[:500]}")
-            return self._fallback_analysis("", context)
+            return None
     
     def _fallback_analysis(self, text: str, context: AnalysisContext) -> AnalysisResult:
         """Fallback analysis when LLM fails"""
         # Simple heuristic: development apps are usually valid for "writing code"
-        dev_apps = ["xcode", "vscode", "terminal", "sublime", "atom", "intellij"]
-        is_dev_app = any(app in context.app_name.lower() for app in dev_apps)
+        app_lower = context.app_name.lower()
+        focus_lower = context.user_focus.lower()
+        is_dev_app = DEV_APP_PATTERN.search(app_lower) is not None
         
         is_valid = False
-        if "code" in context.user_focus.lower() and is_dev_app:
+        if "code" in focus_lower and is_dev_app:
             is_valid = True
-        elif "research" in context.user_focus.lower() and "safari" in context.app_name.lower():
+        elif "research" in focus_lower and "safari" in app_lower:
             is_valid = True
         
         return AnalysisResult(
@@ -235,31 +390,30 @@ JSON response:"""
         """Guess category based on app name"""
         app_lower = app_name.lower()
         
-        categories = {
-            "Development": ["code", "xcode", "terminal", "sublime", "atom", "intellij", "android studio"],
-            "Communication": ["slack", "discord", "teams", "zoom", "mail", "messages"],
-            "Research": ["safari", "chrome", "firefox", "edge", "arc"],
-            "Documentation": ["notes", "notion", "obsidian", "pages", "word"],
-            "Entertainment": ["spotify", "music", "tv", "youtube", "netflix"]
-        }
-        
-        for category, keywords in categories.items():
-            if any(keyword in app_lower for keyword in keywords):
+        for category, pattern in CATEGORY_PATTERNS:
+            if pattern.search(app_lower):
                 return category
         
         return "Other"
 
-analyzer = LLMAnalyzer()
+analyzer: Optional[LLMAnalyzer] = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global analyzer
     logger.info("Starting LLM Analysis Server...")
+    analyzer = LLMAnalyzer()
+    await analyzer.initialize()
     yield
     logger.info("Shutting down LLM Analysis Server...")
+    # ollama's AsyncClient has no close(); release its httpx pool directly.
+    # _client is private to ollama 0.4.0, so keep that version pinned
+    await analyzer.client._client.aclose()
 
 app = FastAPI(
     title="Shoulder LLM Analysis Server",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -294,20 +448,7 @@ async def analyze_activity(request: AnalysisRequest, background_tasks: Backgroun
 async def list_models():
     """List available models"""
     try:
-        response = ollama.list()
-        # Handle both dict and object responses
-        if hasattr(response, 'models'):
-            models_list = response.models
-        else:
-            models_list = response.get('models', [])
-        
-        model_names = []
-        for m in models_list:
-            if hasattr(m, 'name'):
-                model_names.append(m.name)
-            elif isinstance(m, dict):
-                model_names.append(m.get('name', ''))
-        
+        model_names = await analyzer.list_model_names()
         return {"models": model_names}
     except Exception as e:
         return {"models": [], "error": str(e)}
@@ -316,7 +457,7 @@ async def list_models():
 async def pull_model(model_name: str):
     """Pull a new model"""
     try:
-        ollama.pull(model_name)
+        await analyzer.pull_model(model_name)
         return {"status": "success", "model": model_name}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -326,5 +467,7 @@ if __name__ == "__main__":
         app,
         host="127.0.0.1",
         port=8765,
-        log_level="info"
+        log_level="info",
+        loop="uvloop",
+        http="httptools"
     )
\ No newline at end of file
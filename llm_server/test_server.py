@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Regression checks for the LLM Analysis Server
+Run with: python -m unittest test_server
+"""
+
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+import server
+
+async def _ollama_unreachable(*args, **kwargs):
+    raise ConnectionError("Ollama is not running")
+
+class FakeStream:
+    """Stands in for ollama's streamed generate response"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.consumed = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.consumed == len(self.chunks):
+            raise StopAsyncIteration
+        self.consumed += 1
+        return {"response": self.chunks[self.consumed - 1]}
+
+    async def aclose(self):
+        self.closed = True
+
+class JSONObjectScannerTests(unittest.TestCase):
+    def test_braces_inside_strings_are_ignored(self):
+        text = '{"a": "}{"}'
+        self.assertEqual(server.JSONObjectScanner().feed(text), len(text))
+
+    def test_escaped_quote_split_across_chunks(self):
+        scanner = server.JSONObjectScanner()
+        self.assertIsNone(scanner.feed('{"a":"\\'))
+        self.assertEqual(scanner.feed('"}"}'), 4)
+
+    def test_offset_excludes_trailing_text(self):
+        text = '{"a": 1}\n\nSome trailing commentary {x}'
+        end = server.JSONObjectScanner().feed(text)
+        self.assertEqual(text[:end], '{"a": 1}')
+
+    def test_incomplete_object_returns_none(self):
+        scanner = server.JSONObjectScanner()
+        self.assertIsNone(scanner.feed('{"a": {"b": 1}'))
+        self.assertIsNone(scanner.feed(', "c": "}'))
+
+class AnalyzeEndpointTests(unittest.TestCase):
+    def setUp(self):
+        # Keep the checks independent of a local Ollama install
+        for name in ("list", "generate"):
+            patcher = mock.patch.object(server.AsyncClient, name, _ollama_unreachable)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_lone_surrogate_in_text_falls_back(self):
+        """A lone surrogate is valid request JSON and must not cause a 500"""
+        body = (
+            '{"text": "a\\ud800b", "model": "llama3.2:3b", "context": '
+            '{"app_name": "Xcode", "user_focus": "Writing code", '
+            '"timestamp": "2024-01-01T00:00:00"}}'
+        )
+        with TestClient(server.app) as client:
+            response = client.post(
+                "/analyze",
+                content=body,
+                headers={"Content-Type": "application/json"}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["explanation"],
+            "Analysis unavailable - using simple heuristic"
+        )
+
+    def test_stream_closed_after_early_stop(self):
+        """Generation stops at the closing brace and the stream is closed"""
+        stream = FakeStream([
+            '{"is_valid": true, "detected_activity": "Editing Swift", ',
+            '"explanation": "Coding in Xcode", "confidence": 0.9}  ',
+            "\n\n",
+            "never read"
+        ])
+
+        async def fake_generate(*args, **kwargs):
+            return stream
+
+        body = {
+            "text": "func main()",
+            "context": {
+                "app_name": "Xcode",
+                "user_focus": "Writing code",
+                "timestamp": "2024-01-01T00:00:00"
+            }
+        }
+        with mock.patch.object(server.AsyncClient, "generate", fake_generate):
+            with TestClient(server.app) as client:
+                response = client.post("/analyze", json=body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["explanation"], "Coding in Xcode")
+        self.assertEqual(stream.consumed, 2)
+        self.assertTrue(stream.closed)
+
+if __name__ == "__main__":
+    unittest.main()